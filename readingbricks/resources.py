@@ -25,8 +25,10 @@ class DatabaseCreator:
     """
     Creator of SQLite database mapping a tag to a list of notes.
 
-    Namely, tables from the database represent tags and rows of a table
-    represent notes tagged with the corresponding tag.
+    Namely, there is a single table where each row is a pair of a tag
+    and an ID of a note tagged with it; also its position keeps order
+    of notes. The table is indexed by tag and tags are compared
+    case-insensitively (like names of tables).
 
     :param path_to_ipynb_notes:
         path to directory where Jupyter files with notes are located
@@ -53,6 +55,25 @@ class DatabaseCreator:
             tag_to_notes[tag].append(cell_header)
         return tag_to_notes
 
+    @staticmethod
+    def __drop_all_tables(cur: sqlite3.Cursor) -> None:
+        # Drop tables of any previous layout (e.g., a table per tag),
+        # so that the DB is rebuilt from scratch.
+        cur.execute(
+            """
+            SELECT
+                name
+            FROM
+                sqlite_master
+            WHERE
+                type = 'table'
+                AND name NOT LIKE 'sqlite_%'
+            """
+        )
+        for (table_name,) in cur.fetchall():
+            table_name = table_name.replace('"', '""')
+            cur.execute(f'DROP TABLE "{table_name}"')
+
     def __write_tag_to_notes_mapping_to_db(
             self,
             tag_to_notes: defaultdict
@@ -60,26 +81,34 @@ class DatabaseCreator:
         # Write content of `tag_to_notes` to the target DB.
         with closing(sqlite3.connect(self.__path_to_db)) as conn:
             with utils.open_transaction(conn) as cur:
-                for k, v in tag_to_notes.items():
-                    cur.execute(
-                        f"CREATE TABLE IF NOT EXISTS {k} (note_id VARCHAR)"
-                    )
-                    cur.execute(
-                        f"""
-                        CREATE UNIQUE INDEX IF NOT EXISTS
-                            {k}_index
-                        ON
-                            {k} (note_id)
-                        """
-                    )
-                    cur.execute(
-                        f"DELETE FROM {k}"
-                    )
-                    for note_title in v:
-                        cur.execute(
-                            f"INSERT INTO {k} (note_id) VALUES (?)",
-                            (utils.compress(note_title),)
+                self.__drop_all_tables(cur)
+                cur.execute(
+                    """
+                    CREATE TABLE
+                        notes_by_tag (
+                            position INTEGER PRIMARY KEY,
+                            tag VARCHAR COLLATE NOCASE,
+                            note_id VARCHAR,
+                            UNIQUE (tag, note_id)
                         )
+                    """
+                )
+                cur.execute(
+                    """
+                    CREATE INDEX
+                        notes_by_tag_index
+                    ON
+                        notes_by_tag (tag)
+                    """
+                )
+                cur.executemany(
+                    "INSERT INTO notes_by_tag (tag, note_id) VALUES (?, ?)",
+                    [
+                        (tag, utils.compress(note_title))
+                        for tag, note_titles in tag_to_notes.items()
+                        for note_title in note_titles
+                    ]
+                )
             with closing(conn.cursor()) as cur:
                 cur.execute('VACUUM')
 
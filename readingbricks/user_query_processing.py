@@ -7,8 +7,7 @@ Author: Nikolay Lysenko
 
 import sqlite3
 import contextlib
-import string
-from typing import List
+from typing import List, Union
 
 import pyparsing as pp
 
@@ -17,9 +16,9 @@ class LogicalQueriesHandler:
     """
     Processor of queries that returns list of matching notes.
 
-    A query of a special form is converted to SQL statement,
-    database interaction starts, and list of matching notes
-    is returned as a result.
+    A query of a special form is converted to a single SQL statement
+    with tags as bound parameters, database interaction starts, and
+    list of matching notes is returned as a result.
 
     Valid query can involve only tags, logical operators
     (i.e., AND, OR, and NOT), parentheses, and spaces.
@@ -29,18 +28,21 @@ class LogicalQueriesHandler:
     "neural networks" tag and at least one of "problem_setup" and
     "bayesian_methods" tags.
 
-    :param path_to_db:
-        absolute path to SQLite database with tables representing tags
-        and rows representing notes
+    :param conn:
+        connection to SQLite database with a table where each row
+        is a pair of a tag and an ID of a note tagged with it
     """
 
-    def __init__(self, path_to_db: str):
+    __select_by_tag = "SELECT note_id FROM notes_by_tag WHERE tag = ?"
+    __set_operators = {'AND': 'INTERSECT', 'OR': 'UNION'}
+
+    def __init__(self, conn: sqlite3.Connection):
         """Initialize an instance."""
-        self.__path_to_db = path_to_db
+        self.__conn = conn
 
     @staticmethod
-    def __infer_precedence(user_query: str) -> str:
-        # Put square brackets that indicate precedence of operations.
+    def __parse(user_query: str) -> Union[str, pp.ParseResults]:
+        # Build tree of operations with respect to their precedence.
         extra_chars = pp.srange(r"[\0x80-\0x7FF]")  # Support Cyrillic letters.
         tag = pp.Word(pp.alphas + '_' + extra_chars)
         parser = pp.operatorPrecedence(
@@ -52,106 +54,66 @@ class LogicalQueriesHandler:
             ]
         )
         parsed_expression = parser.parseString(user_query)[0]
-        return str(parsed_expression)
+        return parsed_expression
 
-    @staticmethod
-    def __compose_sql_query(operator: str, operands: List[str]) -> str:
-        # Turn logical operation into SQL query that performs it.
-        if operator == 'AND':
-            operands_and_aliases = list(zip(operands, string.ascii_lowercase))
-            query = (
-                f'''
-                SELECT
-                    a.note_id
-                FROM
-                    {operands[0]} a
-                '''
-                + '\n'.join(
-                    [
-                        f'''
-                        JOIN
-                        {operand} {alias}
-                        ON
-                            a.note_id = {alias}.note_id
-                        '''
-                        for operand, alias in operands_and_aliases[1:]
-                    ]
-                )
-            )
-        elif operator == 'OR':
-            query = (
-                "UNION".join(
-                    [
-                        f'''
-                        SELECT
-                            note_id
-                        FROM
-                            {operand}
-                        '''
-                        for operand in operands
-                    ]
-                )
-            )
-        elif operator == 'NOT':
-            query = (
-                f'''
-                SELECT
-                    *
-                FROM
-                    all_notes a
-                WHERE
-                    NOT EXISTS(
-                        SELECT
-                            *
-                        FROM
-                            {operands[0]} b
-                        WHERE
-                            a.note_id = b.note_id
-                    )
-                '''
+    def __compose_sql_query(
+            self,
+            expression: Union[str, pp.ParseResults],
+            tags: List[str]
+    ) -> str:
+        # Turn tree of logical operations into SQL query that performs
+        # them and collect tags that must be bound to its parameters.
+        if isinstance(expression, str):
+            tags.append(expression)
+            return self.__select_by_tag
+        if expression[0] == 'NOT':
+            tags.append('all_notes')
+            operand = self.__compose_sql_query(expression[1], tags)
+            return (
+                f"{self.__select_by_tag} "
+                f"EXCEPT SELECT note_id FROM ({operand})"
             )
-        else:
+        operator = expression[1]
+        if operator not in self.__set_operators:
             raise ValueError(f"Unknown operator: {operator}")
+        operands = [
+            self.__compose_sql_query(operand, tags)
+            for operand in expression[::2]
+        ]
+        # Compound operators in SQLite have equal precedence, so each
+        # operand is wrapped into a subquery.
+        query = f" {self.__set_operators[operator]} ".join(
+            f"SELECT note_id FROM ({operand})" for operand in operands
+        )
         return query
 
-    def __create_tmp_table(self, leaf: List[str], cur: sqlite3.Cursor) -> str:
-        # Create temporary table for a single leaf.
-        # Here, leaf means a part of the parsed user query without any
-        # nested parts in it and a part means anything that is inside
-        # square brackets.
-        if 'NOT' in leaf:
-            operator = 'NOT'
-            operands = [leaf[1]]
-        else:
-            operator = leaf[1]
-            operands = leaf[::2]
-        query = self.__compose_sql_query(operator, operands)
-        tmp_table_name = '_'.join(leaf)
-        cur.execute(f"CREATE TEMP TABLE {tmp_table_name} AS {query}")
+    @staticmethod
+    def __validate_tags(tags: List[str], cur: sqlite3.Cursor) -> None:
+        # Check that all tags from the query exist. Tags are compared
+        # with collation of the column, because it is on the left side.
+        unique_tags = sorted(set(tags))
+        values = ', '.join('(?)' for _ in unique_tags)
         cur.execute(
-            f'''
-            CREATE UNIQUE INDEX IF NOT EXISTS
-                {tmp_table_name}_index ON {tmp_table_name} (note_id)
-            '''
+            f"""
+            SELECT
+                column1
+            FROM
+                (VALUES {values})
+            WHERE
+                NOT EXISTS(
+                    SELECT
+                        *
+                    FROM
+                        notes_by_tag
+                    WHERE
+                        tag = column1
+                )
+            """,
+            tuple(unique_tags)
         )
-        return f"'{tmp_table_name}'"
-
-    def __replace_leaf_with_tmp_table(
-            self,
-            parsed_query: str,
-            cur: sqlite3.Cursor
-    ) -> str:
-        # Create a temporary table for a single leaf and return a query
-        # where this leaf is replaced with the name of the temporary table.
-        parts = parsed_query.split(']')
-        left_part = parts.pop(0)
-        left_parts = left_part.split('[')
-        leaf = left_parts.pop()
-        pre_leaf = '['.join(left_parts)
-        post_leaf = ']'.join(parts)
-        leaf_as_list = leaf.replace("'", "").split(', ')
-        tmp_table_name = self.__create_tmp_table(leaf_as_list, cur)
-        return pre_leaf + tmp_table_name + post_leaf
+        unknown_tags = [x[0] for x in cur.fetchall()]
+        if unknown_tags:
+            raise ValueError(f"Unknown tags: {', '.join(unknown_tags)}")
 
     def find_all_relevant_notes(self, user_query: str) -> List[str]:
         """
@@ -163,16 +125,34 @@ class LogicalQueriesHandler:
             "neural_networks AND (problem_setup OR bayesian_methods)"
         :return:
             IDs of matching notes
+        :raises ValueError:
+            if query can not be parsed or contains unknown tags
         """
-        parsed_query = self.__infer_precedence(user_query)
-        with contextlib.closing(sqlite3.connect(self.__path_to_db)) as conn:
-            with contextlib.closing(conn.cursor()) as cur:
-                while ']' in parsed_query:
-                    parsed_query = self.__replace_leaf_with_tmp_table(
-                        parsed_query, cur
-                    )
-                tmp_table_name = parsed_query.strip("'")
-                cur.execute(f"SELECT note_id FROM {tmp_table_name}")
-                query_result = cur.fetchall()
-                note_ids = [x[0] for x in query_result]
+        try:
+            parsed_query = self.__parse(user_query)
+        except pp.ParseException as e:
+            raise ValueError(f"Invalid query: {user_query}") from e
+        # Compound query is used only as a filter, because its rows
+        # are sorted by note ID, whereas notes must follow the order
+        # of their appearance in notebooks.
+        tags = ['all_notes']
+        filter_query = self.__compose_sql_query(parsed_query, tags)
+        sql_query = (
+            f"""
+            SELECT
+                note_id
+            FROM
+                notes_by_tag
+            WHERE
+                tag = ?
+                AND note_id IN ({filter_query})
+            ORDER BY
+                position
+            """
+        )
+        with contextlib.closing(self.__conn.cursor()) as cur:
+            self.__validate_tags(tags, cur)
+            cur.execute(sql_query, tuple(tags))
+            query_result = cur.fetchall()
+        note_ids = [x[0] for x in query_result]
         return note_ids
@@ -9,8 +9,11 @@ import os
 import json
 import sqlite3
 import hashlib
-from contextlib import contextmanager
-from typing import Dict, Generator, Any
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager, suppress
+from typing import Dict, Generator, Hashable, Optional, Any
 
 # Note that there must be no dependencies other than Python built-ins,
 # because this module is imported by scripts from `supplementaries`.
@@ -56,6 +59,41 @@ def compress(string: str, max_length: int = 64) -> str:
     return result
 
 
+def write_atomically(
+        path: str,
+        content: str,
+        mtime_ns: Optional[int] = None
+) -> None:
+    """
+    Write content to a file so that it is never seen partially written.
+
+    :param path:
+        path to destination file
+    :param content:
+        text to be written
+    :param mtime_ns:
+        modification time (in nanoseconds) to be set to the file;
+        if it is not passed, time of writing is kept
+    :return:
+        None
+    """
+    tmp_file = tempfile.NamedTemporaryFile(
+        'w', encoding='utf-8',
+        dir=os.path.dirname(path), suffix='.tmp', delete=False
+    )
+    try:
+        with tmp_file:
+            tmp_file.write(content)
+        if mtime_ns is not None:
+            os.utime(tmp_file.name, ns=(mtime_ns, mtime_ns))
+        os.replace(tmp_file.name, path)
+    except BaseException:
+        # Temporary file must not be left whatever the failure is.
+        with suppress(OSError):
+            os.unlink(tmp_file.name)
+        raise
+
+
 @contextmanager
 def open_transaction(
         conn: sqlite3.Connection
@@ -72,3 +110,52 @@ def open_transaction(
         cur.execute('COMMIT')
     finally:
         cur.close()
+
+
+class LRUCache:
+    """
+    Thread-safe storage that evicts the least recently used items.
+
+    :param max_size:
+        maximum number of items to be stored, default is 1024
+    """
+
+    def __init__(self, max_size: int = 1024):
+        """Initialize an instance."""
+        self.__max_size = max_size
+        self.__storage = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Return value stored for a key and mark it as recently used.
+
+        :param key:
+            key of an item
+        :param default:
+            value to be returned if there is no such key, default is `None`
+        :return:
+            stored value or `default`
+        """
+        with self.__lock:
+            if key not in self.__storage:
+                return default
+            self.__storage.move_to_end(key)
+            return self.__storage[key]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """
+        Store value for a key and evict the oldest item if cache is full.
+
+        :param key:
+            key of an item
+        :param value:
+            value to be stored
+        :return:
+            None
+        """
+        with self.__lock:
+            self.__storage[key] = value
+            self.__storage.move_to_end(key)
+            if len(self.__storage) > self.__max_size:
+                self.__storage.popitem(last=False)
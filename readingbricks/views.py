@@ -5,46 +5,106 @@ Author: Nikolay Lysenko
 """
 
 
+import io
 import os
+import re
+import stat
 import sqlite3
 import contextlib
-from functools import reduce
-from typing import List, Tuple, Optional
+import functools
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Optional, Union, Generator, Any
 
-from flask import render_template, url_for, request
-from flask_misaka import Misaka
-from markupsafe import Markup
+import misaka
+from flask import (
+    Response, g, render_template, request, stream_with_context, url_for
+)
+from markupsafe import Markup, escape
 
 from readingbricks import app, utils
 from readingbricks.user_query_processing import LogicalQueriesHandler
 
 
-markdown_preprocessor = Misaka()
-markdown_preprocessor.init_app(app)
+markdown_preprocessor = misaka.Markdown(
+    misaka.HtmlRenderer(),
+    extensions=('math', 'math-explicit', 'no-intra-emphasis')
+)
+HOME_URL_PLACEHOLDER = '__home_url__/'
+rendered_notes_cache = utils.LRUCache(max_size=1024)
+tags_cloud_cache = utils.LRUCache(max_size=16)
+thread_local_storage = threading.local()
+notes_reader = ThreadPoolExecutor(max_workers=8)
 
 
-@app.route('/')
-def index() -> str:
-    """Render home page."""
-    tags_with_counts = []
+def get_connection_to_db() -> sqlite3.Connection:
+    """
+    Return read-only connection to SQLite DB that is kept by current thread.
+
+    The connection is opened once per thread (and re-opened only if path
+    to DB is changed), so requests do not pay for opening DB file.
+    """
+    path_to_db = app.config.get('path_to_db')
+    conn = getattr(thread_local_storage, 'conn', None)
+    if conn is not None and thread_local_storage.path_to_db == path_to_db:
+        return conn
+    if conn is not None:
+        conn.close()
+    uri = f'file:{urllib.request.pathname2url(path_to_db)}?mode=ro'
+    conn = sqlite3.connect(uri, uri=True, cached_statements=128)
+    conn.execute('PRAGMA query_only = 1')
+    conn.execute('PRAGMA cache_size = -20000')
+    thread_local_storage.conn = conn
+    thread_local_storage.path_to_db = path_to_db
+    return conn
+
+
+def get_home_url() -> str:
+    """Return external URL of home page, computing it once per request."""
+    if 'home_url' not in g:
+        g.home_url = url_for('index', _external=True)
+    return g.home_url
+
+
+def make_tags_cloud(home_url: str) -> Markup:
+    """
+    Convert TSV file with counts of tags into HTML with links to tags.
+
+    Result is cached in memory until the source file is modified.
+    """
     path_to_counts_of_tags = app.config.get('path_to_counts_of_tags')
+    mtime = os.stat(path_to_counts_of_tags).st_mtime_ns
+    cache_key = (path_to_counts_of_tags, home_url)
+    cached_mtime, cached_html = tags_cloud_cache.get(cache_key, (None, None))
+    if cached_mtime == mtime:
+        return cached_html
     with open(path_to_counts_of_tags) as source_file:
-        for line in source_file:
-            tags_with_counts.append(line.split('\t'))
-    home_url = url_for('index', _external=True)
-    link_names = [
-        f'{tag} ({count.strip()})' for (tag, count) in tags_with_counts
+        content = source_file.read()
+    tags_with_counts = [
+        line.split('\t', 1) for line in content.splitlines() if line
     ]
-    links_to_tags = [
-        f'<a href={home_url}tags/{tag} class="button">{name}</a>\n'
-        for (tag, counts), name in zip(tags_with_counts, link_names)
-    ]
-    tags_cloud = Markup(''.join(links_to_tags))
+    buffer = io.StringIO()
+    for tag, count in tags_with_counts:
+        buffer.write(
+            f'<a href={home_url}tags/{tag} class="button">'
+            f'{tag} ({count.strip()})</a>\n'
+        )
+    tags_cloud = Markup(buffer.getvalue())
+    tags_cloud_cache.put(cache_key, (mtime, tags_cloud))
+    return tags_cloud
+
+
+@app.route('/')
+def index() -> str:
+    """Render home page."""
+    home_url = get_home_url()
+    tags_cloud = make_tags_cloud(home_url)
     content_with_css = render_template('index.html', **locals())
     return content_with_css
 
 
-def make_link_from_title(md_title: str) -> str:
+def make_link_from_title(md_title: str, home_url: str) -> str:
     """
     Convert Markdown title to Markdown title with link.
 
@@ -52,90 +112,209 @@ def make_link_from_title(md_title: str) -> str:
     '## Title' -> '## [Title](URL)'
     """
     note_title = md_title.lstrip('# ').rstrip('\n')
-    home_url = url_for('index', _external=True)
-    result = '## ' + f'[{note_title}]({home_url}notes/{note_title})\n'
+    result = f'## [{note_title}]({home_url}notes/{note_title})\n'
     return result
 
 
-def activate_cross_links(content_in_markdown: str) -> str:
+def activate_cross_links(content: str, home_url: str) -> str:
     """
     Make links to other notes valid.
 
     Substring '__home_url__' is reserved for links to the root of the
     web app and here this substring is replaced with actual URL.
+    It is done after rendering, so HTML of a note does not depend
+    on host and can be stored on disk. Since the URL is inserted into
+    HTML, it is escaped (it comes from `Host` header of a request).
     """
-    home_url = url_for('index', _external=True)
-    content_in_markdown = content_in_markdown.replace(
-        '__home_url__/', home_url
-    )
-    return content_in_markdown
+    if HOME_URL_PLACEHOLDER not in content:
+        return content
+    content = content.replace(HOME_URL_PLACEHOLDER, str(escape(home_url)))
+    return content
 
 
-def convert_note_from_markdown_to_html(note_id: str) -> Optional[Markup]:
+def render_markdown(content_in_markdown: str) -> Markup:
+    """
+    Convert Markdown to HTML with bindings to Hoedown C library.
+
+    Both renderer and extensions are set up once at import time,
+    so nothing but parsing itself happens on a per-note basis.
+    Also blank line that Hoedown puts between a paragraph and a list
+    is removed here, because output of this function is cached.
+    """
+    content_in_html = markdown_preprocessor(content_in_markdown)
+    content_in_html = content_in_html.replace('</p>\n\n<ul>', '</p>\n<ul>')
+    return Markup(content_in_html)
+
+
+def render_note(abs_path_to_md: str) -> str:
+    """Convert a Markdown note to HTML with links to home URL unresolved."""
+    with open(abs_path_to_md, 'r') as source_file:
+        md_title, _, md_body = source_file.read().partition('\n')
+    md_title_as_link = make_link_from_title(md_title, HOME_URL_PLACEHOLDER)
+    content_in_markdown = md_title_as_link + md_body
+    return str(render_markdown(content_in_markdown))
+
+
+def read_html_if_fresh(
+        abs_path_to_html: str, md_mtime_ns: int
+) -> Optional[str]:
+    """Read stored HTML of a note if it is up to date, else return `None`."""
+    try:
+        if os.stat(abs_path_to_html).st_mtime_ns != md_mtime_ns:
+            return None
+        with open(abs_path_to_html, 'r', encoding='utf-8') as source_file:
+            return source_file.read()
+    except OSError:
+        return None
+
+
+def load_or_render_note(abs_path_to_md: str, md_mtime_ns: int) -> str:
+    """
+    Return HTML of a note with links to home URL unresolved.
+
+    The HTML is stored in a file that is placed next to the Markdown file
+    and that has the same modification time. If such file is missing or
+    outdated, it is rewritten.
+    """
+    abs_path_to_html = os.path.splitext(abs_path_to_md)[0] + '.html'
+    content_in_html = read_html_if_fresh(abs_path_to_html, md_mtime_ns)
+    if content_in_html is not None:
+        return content_in_html
+    content_in_html = render_note(abs_path_to_md)
+    try:
+        utils.write_atomically(abs_path_to_html, content_in_html, md_mtime_ns)
+    except Exception:  # pragma: no cover
+        pass  # Disk cache is optional, e.g., directory can be read-only.
+    return content_in_html
+
+
+def convert_note_from_markdown_to_html(
+        note_id: str, home_url: str
+) -> Optional[Markup]:
     """
     Convert a Markdown file into `Markup` instance with HTML inside.
 
     If requested note does not exist, return `None`.
+    Results are cached in memory and on disk until the source file
+    is modified. Home URL is passed explicitly, because the function
+    can be called outside of request context (namely, from a pool
+    of threads).
     """
     dir_path = app.config.get('path_to_markdown_notes')
     abs_requested_path = os.path.join(dir_path, f'{note_id}.md')
-    if not os.path.isfile(abs_requested_path):
+    try:
+        file_stat = os.stat(abs_requested_path)
+    except OSError:
         return None
-    with open(abs_requested_path, 'r') as source_file:
-        md_title = source_file.readline()
-        md_title_as_link = make_link_from_title(md_title)
-        content_in_markdown = md_title_as_link + source_file.read()
-    content_in_markdown = activate_cross_links(content_in_markdown)
-    content_in_html = markdown_preprocessor.render(
-        content_in_markdown,
-        math=True, math_explicit=True, no_intra_emphasis=True
+    if not stat.S_ISREG(file_stat.st_mode):
+        return None
+    # Rendered HTML contains absolute links, so they are a part of the key.
+    cache_key = (abs_requested_path, home_url)
+    cached_mtime, cached_html = rendered_notes_cache.get(
+        cache_key, (None, None)
+    )
+    if cached_mtime == file_stat.st_mtime_ns:
+        return cached_html
+    content_in_html = load_or_render_note(
+        abs_requested_path, file_stat.st_mtime_ns
+    )
+    content_in_html = Markup(activate_cross_links(content_in_html, home_url))
+    rendered_notes_cache.put(
+        cache_key, (file_stat.st_mtime_ns, content_in_html)
     )
     return content_in_html
 
 
+@app.cli.command('reindex')
+def reindex() -> None:
+    """Render all Markdown notes to HTML files that are used as a cache."""
+    dir_path = app.config.get('path_to_markdown_notes')
+    for file_name in os.listdir(dir_path):
+        if not file_name.endswith('.md'):
+            continue
+        abs_path_to_md = os.path.join(dir_path, file_name)
+        abs_path_to_html = os.path.splitext(abs_path_to_md)[0] + '.html'
+        md_mtime_ns = os.stat(abs_path_to_md).st_mtime_ns
+        utils.write_atomically(
+            abs_path_to_html, render_note(abs_path_to_md), md_mtime_ns
+        )
+
+
 @app.route('/notes/<note_title>')
 def page_with_note(note_title: str) -> str:
     """Render in HTML a page with exactly one note."""
     note_id = utils.compress(note_title)
-    content_in_html = convert_note_from_markdown_to_html(note_id)
+    home_url = get_home_url()
+    content_in_html = convert_note_from_markdown_to_html(note_id, home_url)
     if content_in_html is None:
         return render_template('404.html')
     title = note_title
+    notes_in_html = [content_in_html]
     content_with_css = render_template('regular_page.html', **locals())
-    content_with_css = content_with_css.replace('</p>\n\n<ul>', '</p>\n<ul>')
     return content_with_css
 
 
-def page_for_list_of_ids(note_ids: List[str], page_title: str) -> str:
-    """Render in HTML a page with all notes from the specified list."""
-    notes_content = []
-    for note_id in note_ids:
-        notes_content.append(convert_note_from_markdown_to_html(note_id))
-    content_in_html = reduce(lambda x, y: x + y, notes_content)
-    content_with_css = render_template('regular_page.html', **locals())
-    content_with_css = content_with_css.replace('</p>\n\n<ul>', '</p>\n<ul>')
-    return content_with_css
+def stream_template(
+        template_name: str, **context: Any
+) -> Generator[str, None, None]:
+    """Render template lazily, piece by piece."""
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    return template.generate(context)
+
+
+def page_for_list_of_ids(note_ids: List[str], page_title: str) -> Response:
+    """
+    Render in HTML a page with all notes from the specified list.
+
+    The page is streamed, so its head and its first notes are sent
+    before the remaining notes are converted to HTML.
+    """
+    home_url = get_home_url()
+    convert = functools.partial(
+        convert_note_from_markdown_to_html, home_url=home_url
+    )
+    # Order of notes is preserved by `map`.
+    notes_content = notes_reader.map(convert, note_ids)
+    notes_in_html = (x for x in notes_content if x is not None)
+    content_with_css = stream_template('regular_page.html', **locals())
+    return Response(stream_with_context(content_with_css))
 
 
 @app.route('/tags/<tag>')
-def page_for_tag(tag: str) -> str:
+def page_for_tag(tag: str) -> Union[str, Response]:
     """Render in HTML a page with all notes that have the specified tag."""
-    path_to_db = app.config.get('path_to_db')
+    if not re.fullmatch(r'\w+', tag):
+        return render_template('404.html')
     try:
-        with contextlib.closing(sqlite3.connect(path_to_db)) as conn:
-            with contextlib.closing(conn.cursor()) as cur:
-                cur.execute(f"SELECT note_id FROM {tag}")
-                query_result = cur.fetchall()
-        note_ids = [x[0] for x in query_result]
+        conn = get_connection_to_db()
+        with contextlib.closing(conn.cursor()) as cur:
+            cur.execute(
+                """
+                SELECT
+                    note_id
+                FROM
+                    notes_by_tag
+                WHERE
+                    tag = ?
+                ORDER BY
+                    position
+                """,
+                (tag,)
+            )
+            query_result = cur.fetchall()
     except sqlite3.OperationalError:
         return render_template('404.html')
+    note_ids = [x[0] for x in query_result]
+    if not note_ids:
+        return render_template('404.html')
     page_title = (tag[0].upper() + tag[1:]).replace('_', ' ')
     content_with_css = page_for_list_of_ids(note_ids, page_title)
     return content_with_css
 
 
 @app.route('/query', methods=['POST'])
-def page_for_query() -> str:
+def page_for_query() -> Union[str, Response]:
     """
     Render in HTML a page with all notes that match user query.
 
@@ -144,11 +323,10 @@ def page_for_query() -> str:
     user_query = request.form['query']
     default = "нейронные_сети AND (постановка_задачи OR байесовские_методы)"
     user_query = user_query or default
-    path_to_db = app.config.get('path_to_db')
-    query_handler = LogicalQueriesHandler(path_to_db)
     try:
+        query_handler = LogicalQueriesHandler(get_connection_to_db())
         note_ids = query_handler.find_all_relevant_notes(user_query)
-    except sqlite3.OperationalError:
+    except (ValueError, sqlite3.OperationalError):
         content_with_css = render_template('invalid_query.html', **locals())
         return content_with_css
     if len(note_ids) > 0:
@@ -9,5 +9,6 @@ from readingbricks import app
 from readingbricks.resources import provide_resources
 
 
-provide_resources()
-app.run(debug=True)
+if __name__ == '__main__':
+    provide_resources()
+    app.run(threaded=True)
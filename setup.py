@@ -28,7 +28,7 @@ setup(
     include_package_data=True,  # For CSS files and so on.
     python_requires='>=3.6',
     install_requires=[
-        'Flask', 'Flask-Markdown', 'Flask-Misaka',
+        'Flask', 'Flask-Markdown', 'misaka',
         'pyparsing', 'python-markdown-math'
     ]
 )
@@ -7,6 +7,7 @@ Author: Nikolay Lysenko
 
 import unittest
 import os
+import tempfile
 
 from readingbricks import utils
 
@@ -50,12 +51,59 @@ class TestJupyterCellsExtraction(unittest.TestCase):
         self.assertEqual(digits_content, true_digits_content)
 
 
+class TestLRUCache(unittest.TestCase):
+    """Tests of in-memory cache."""
+
+    def test_get_and_put(self) -> None:
+        """Test that stored values are returned."""
+        cache = utils.LRUCache(max_size=2)
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('b', 0), 0)
+
+    def test_eviction(self) -> None:
+        """Test that the least recently used item is evicted."""
+        cache = utils.LRUCache(max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+
+class TestAtomicWriting(unittest.TestCase):
+    """Tests of writing files atomically."""
+
+    def test_write_atomically(self) -> None:
+        """Test that content and modification time are written."""
+        with tempfile.TemporaryDirectory() as dir_path:
+            path = os.path.join(dir_path, 'note.html')
+            utils.write_atomically(path, 'Заметка', mtime_ns=10 ** 9)
+            with open(path, encoding='utf-8') as result_file:
+                self.assertEqual(result_file.read(), 'Заметка')
+            self.assertEqual(os.stat(path).st_mtime_ns, 10 ** 9)
+            self.assertEqual(os.listdir(dir_path), ['note.html'])
+
+    def test_write_atomically_with_failure(self) -> None:
+        """Test that no temporary file is left after a failure."""
+        with tempfile.TemporaryDirectory() as dir_path:
+            path = os.path.join(dir_path, 'note.html')
+            with self.assertRaises(TypeError):
+                utils.write_atomically(path, None)
+            self.assertEqual(os.listdir(dir_path), [])
+
+
 def main():
     """Run tests."""
     test_loader = unittest.TestLoader()
     suites_list = []
     testers = [
-        TestJupyterCellsExtraction()
+        TestJupyterCellsExtraction(),
+        TestLRUCache(),
+        TestAtomicWriting()
     ]
     for tester in testers:
         suite = test_loader.loadTestsFromModule(tester)
@@ -8,8 +8,11 @@ Author: Nikolay Lysenko
 import unittest
 import os
 
-from readingbricks import app
+from readingbricks import app, utils
 from readingbricks.resources import provide_resources
+from readingbricks.views import (
+    page_for_list_of_ids, page_for_query, page_for_tag
+)
 
 
 class TestViews(unittest.TestCase):
@@ -68,6 +71,29 @@ class TestViews(unittest.TestCase):
         result = self.app.get('/notes/non_existing').data.decode('utf-8')
         self.assertTrue('Страница не найдена.' in result)
 
+    def test_disk_cache_of_note(self) -> None:
+        """Test that HTML of a note is stored next to its Markdown file."""
+        self.app.get('/notes/A')
+        dir_path = app.config['path_to_markdown_notes']
+        note_id = utils.compress('A')
+        md_path = os.path.join(dir_path, f'{note_id}.md')
+        html_path = os.path.join(dir_path, f'{note_id}.html')
+        self.assertTrue(os.path.isfile(html_path))
+        self.assertEqual(
+            os.stat(html_path).st_mtime_ns, os.stat(md_path).st_mtime_ns
+        )
+        with open(html_path) as html_file:
+            self.assertTrue('__home_url__/notes/A' in html_file.read())
+
+    def test_hostile_host_header(self) -> None:
+        """Test that `Host` header can not inject HTML into a note."""
+        for host in ['h<script>', 'a.b"onmouseover="x']:
+            response = self.app.get('/notes/C', headers={'Host': host})
+            result = response.data.decode('utf-8')
+            self.assertTrue('C:' in result)
+            self.assertFalse('<script>' in result)
+            self.assertFalse('"onmouseover' in result)
+
     def test_page_for_tag(self) -> None:
         """Test page with all notes tagged with a specified tag."""
         result = self.app.get('/tags/digits').data.decode('utf-8')
@@ -78,9 +104,22 @@ class TestViews(unittest.TestCase):
         self.assertTrue(self.title_template.format(title='C') in result)
         self.assertFalse(self.title_template.format(title='A') in result)
 
+        result = self.app.get('/tags/Letters').data.decode('utf-8')
+        self.assertTrue(self.title_template.format(title='A') in result)
+
         result = self.app.get('/tags/non_existing').data.decode('utf-8')
         self.assertTrue('Страница не найдена.' in result)
 
+    def test_page_for_list_with_missing_notes(self) -> None:
+        """Test that missing notes are skipped on a page with notes."""
+        note_ids = [utils.compress('A'), 'non_existing', utils.compress('B')]
+        with app.test_request_context():
+            response = page_for_list_of_ids(note_ids, 'Letters')
+            result = response.get_data(as_text=True)
+        self.assertTrue(self.title_template.format(title='A') in result)
+        self.assertTrue(self.title_template.format(title='B') in result)
+        self.assertFalse('None' in result)
+
     def test_page_for_query_with_and(self) -> None:
         """Test search bar requests with AND operator."""
         query = 'list AND letters'
@@ -159,6 +198,50 @@ class TestViews(unittest.TestCase):
         result = response.data.decode('utf-8')
         self.assertTrue('<h2>Запрос не может быть обработан</h2>' in result)
 
+    def test_page_for_invalid_query(self) -> None:
+        """Test search bar requests that can not be processed."""
+        queries = [
+            '(',
+            'letters AND unknown_tag',
+            'letters OR ' * 599 + 'letters'
+        ]
+        for query in queries:
+            response = self.app.post('/query', data={'query': query})
+            result = response.data.decode('utf-8')
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(
+                '<h2>Запрос не может быть обработан</h2>' in result
+            )
+
+    def test_order_of_notes_for_query(self) -> None:
+        """Test that notes matching a query keep order from notebooks."""
+        query = 'letters AND NOT (list OR digits)'
+        response = self.app.post('/query', data={'query': query})
+        result = response.data.decode('utf-8')
+        positions = [
+            result.find(self.title_template.format(title=title))
+            for title in ['A', 'B', 'D']
+        ]
+        self.assertTrue(-1 < positions[0] < positions[1] < positions[2])
+        self.assertFalse(self.title_template.format(title='C') in result)
+
+    def test_streaming_of_pages_with_lists(self) -> None:
+        """Test that pages with lists of notes are streamed."""
+        # Test client wraps any response into iterator, so views are
+        # called directly here.
+        with app.test_request_context('/tags/digits'):
+            response = page_for_tag('digits')
+            self.assertTrue(response.is_streamed)
+            result = response.get_data(as_text=True)
+        self.assertTrue(self.title_template.format(title='1') in result)
+
+        data = {'query': 'list OR digits'}
+        with app.test_request_context('/query', method='POST', data=data):
+            response = page_for_query()
+            self.assertTrue(response.is_streamed)
+            result = response.get_data(as_text=True)
+        self.assertTrue(self.title_template.format(title='C') in result)
+
 
 def main():
     """Run tests."""